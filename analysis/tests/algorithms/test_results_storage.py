@@ -0,0 +1,449 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import configparser
+import uuid
+from collections import namedtuple
+from datetime import datetime
+
+import mock
+import pytest
+from cassandra import InvalidRequest
+from webservice.algorithms.doms import ResultsStorage as results_storage
+from webservice.algorithms.doms.ResultsStorage import AbstractResultsContainer, ResultsStorage, ResultsRetrieval, \
+    ResultInsertException, BATCH_MAX_BYTES, FETCH_SIZE, ROW_OVERHEAD_BYTES, SESSION_CACHE_SIZE
+
+MODULE = 'webservice.algorithms.doms.ResultsStorage'
+
+DataRow = namedtuple('DataRow', [
+    'execution_id', 'is_primary', 'id', 'depth', 'device', 'file_url', 'measurement_time',
+    'measurement_values_json', 'platform', 'primary_value_id', 'source_dataset', 'value_id', 'x', 'y'
+])
+
+OldSchemaDataRow = namedtuple('OldSchemaDataRow', [
+    'execution_id', 'is_primary', 'id', 'depth', 'device', 'measurement_time', 'measurement_values',
+    'platform', 'primary_value_id', 'source_dataset', 'value_id', 'x', 'y'
+])
+
+
+def make_row(execution_id, value_id, values_json='[]', file_url=None):
+    return (
+        uuid.uuid4(),
+        execution_id,
+        value_id,
+        None,
+        -120.0,
+        35.0,
+        'test-dataset',
+        datetime(2018, 9, 27, 9, 0),
+        None,
+        None,
+        values_json,
+        1,
+        0.0,
+        file_url
+    )
+
+
+def make_result(value_id, matches=()):
+    return {
+        'id': value_id,
+        'lon': -120.0,
+        'lat': 35.0,
+        'source': 'test-dataset',
+        'time': datetime(2018, 9, 27, 9, 0),
+        'depth': 0.0,
+        'fileurl': None,
+        'primary': [{'variable_name': 'sst', 'variable_value': 20.0}],
+        'matches': list(matches)
+    }
+
+
+def statement_rows(statement):
+    # Rows carried by a statement passed to execute_concurrent; batches are MagicMocks (see fixture)
+    stmt, params = statement
+
+    if isinstance(stmt, mock.MagicMock):
+        return [call.args[1] for call in stmt.add.call_args_list]
+
+    return [params]
+
+
+@pytest.fixture()
+def storage():
+    storage = ResultsStorage()
+    storage._session = mock.MagicMock()
+    storage._prep_data = mock.sentinel.prep_data
+    storage._batch_rows = 3
+    storage._write_concurrency = 10
+
+    with mock.patch(f'{MODULE}.BatchStatement', side_effect=lambda **kwargs: mock.MagicMock()):
+        yield storage
+
+
+def test_group_result_batches():
+    exec_a = uuid.uuid4()
+    exec_b = uuid.uuid4()
+
+    small = [make_row(exec_a, f'a{i}') for i in range(4)]
+    oversized = make_row(exec_a, 'big', 'x' * (BATCH_MAX_BYTES + 1))
+    trailing = make_row(exec_a, 'a4')
+    other = [make_row(exec_b, f'b{i}') for i in range(2)]
+
+    groups = list(ResultsStorage._ResultsStorage__group_result_batches(
+        small + [oversized, trailing] + other, 3
+    ))
+
+    assert groups == [small[:3], small[3:], [oversized], [trailing], other]
+
+
+def test_group_result_batches_counts_whole_row_size():
+    execution_id = uuid.uuid4()
+
+    # The JSON alone would fit 100 rows in a batch; the file URL and other columns do not
+    rows = [make_row(execution_id, f'a{i}', 'x' * 300, 'https://example.com/' + 'y' * 280) for i in range(100)]
+
+    groups = list(ResultsStorage._ResultsStorage__group_result_batches(rows, 100))
+
+    assert len(groups) > 1
+    assert [row for group in groups for row in group] == rows
+
+    for group in groups:
+        assert len(group) * (ROW_OVERHEAD_BYTES + 600 + len('test-dataset') + 2) <= BATCH_MAX_BYTES
+
+
+def test_insert_result_batches_writes_single_rows_as_plain_statements(storage):
+    execution_id = uuid.uuid4()
+    rows = [make_row(execution_id, f'a{i}') for i in range(3)]
+    oversized = make_row(execution_id, 'big', 'x' * (BATCH_MAX_BYTES + 1))
+
+    written = []
+
+    def execute(session, statements, **kwargs):
+        written.extend(statements)
+        return [(True, None)] * len(written)
+
+    with mock.patch(f'{MODULE}.execute_concurrent', side_effect=execute):
+        failed = storage._ResultsStorage__insert_result_batches(rows + [oversized])
+
+    assert failed == []
+
+    statements = written
+    assert len(statements) == 2
+    assert statement_rows(statements[0]) == rows
+    assert statements[1] == (mock.sentinel.prep_data, oversized)
+
+
+def test_insert_result_batches_returns_rows_of_failed_batches(storage):
+    execution_id = uuid.uuid4()
+    rows = [make_row(execution_id, f'a{i}') for i in range(8)]
+
+    def execute(session, statements, **kwargs):
+        list(statements)
+        return [(True, None), (False, Exception('timeout')), (True, None)]
+
+    with mock.patch(f'{MODULE}.execute_concurrent', side_effect=execute):
+        failed = storage._ResultsStorage__insert_result_batches(rows)
+
+    assert failed == rows[3:6]
+
+
+def test_insert_result_batches_raises_errors_swallowed_by_driver(storage):
+    execution_id = uuid.uuid4()
+    rows = [make_row(execution_id, f'a{i}') for i in range(8)]
+
+    def execute(session, statements, **kwargs):
+        # Like the driver's executor, which pulls later statements from an I/O callback that only handles
+        # StopIteration, drop any other exception and report what was sent
+        results = []
+
+        try:
+            for _ in statements:
+                results.append((True, None))
+        except Exception:
+            pass
+
+        return results
+
+    def bad_batch(**kwargs):
+        batch = mock.MagicMock()
+        batch.add.side_effect = TypeError('cannot serialize')
+        return batch
+
+    with mock.patch(f'{MODULE}.execute_concurrent', side_effect=execute), \
+            mock.patch(f'{MODULE}.BatchStatement', side_effect=[mock.MagicMock(), bad_batch()]):
+        with pytest.raises(TypeError):
+            storage._ResultsStorage__insert_result_batches(rows)
+
+
+def test_insert_result_batches_splits_rejected_batches(storage):
+    execution_id = uuid.uuid4()
+    rows = [make_row(execution_id, f'a{i}') for i in range(5)]
+    attempts = []
+
+    def execute(session, statements, **kwargs):
+        statements = list(statements)
+        attempts.append(statements)
+
+        if len(attempts) == 1:
+            return [(False, InvalidRequest('Batch too large')), (False, Exception('timeout'))]
+
+        return [(True, None)] * len(statements)
+
+    with mock.patch(f'{MODULE}.execute_concurrent', side_effect=execute):
+        failed = storage._ResultsStorage__insert_result_batches(rows)
+
+    # The rejected batch is rewritten row by row in the same attempt; the timed out one is left for a retry
+    assert failed == rows[3:]
+    assert len(attempts) == 2
+    assert attempts[1] == [(mock.sentinel.prep_data, row) for row in rows[:3]]
+
+
+def test_insert_results_retries_only_failed_rows(storage):
+    execution_id = uuid.uuid4()
+    results = [make_result(f'p{i}') for i in range(4)]
+    attempts = []
+
+    def execute(session, statements, **kwargs):
+        statements = list(statements)
+        attempts.append([row for statement in statements for row in statement_rows(statement)])
+        return [(i != 0 or len(attempts) > 1, None) for i in range(len(statements))]
+
+    with mock.patch(f'{MODULE}.execute_concurrent', side_effect=execute), mock.patch(f'{MODULE}.sleep') as mock_sleep:
+        storage._ResultsStorage__insertResults(execution_id, results)
+
+    assert len(attempts) == 2
+    assert [row[2] for row in attempts[0]] == ['p0', 'p1', 'p2', 'p3']
+    assert attempts[1] == attempts[0][:3]
+    assert mock_sleep.call_count == 1
+
+
+def test_insert_results_raises_after_max_retries(storage):
+    execution_id = uuid.uuid4()
+    results = [make_result('p0', matches=[make_result('s0')])]
+
+    with mock.patch(f'{MODULE}.execute_concurrent') as mock_execute, mock.patch(f'{MODULE}.sleep') as mock_sleep:
+        mock_execute.side_effect = lambda session, statements, **kwargs: [(False, Exception())] * len(list(statements))
+
+        with pytest.raises(ResultInsertException):
+            storage._ResultsStorage__insertResults(execution_id, results)
+
+    assert mock_execute.call_count == 5
+    assert mock_sleep.call_count == 4
+
+
+class FakeResponseFuture:
+    # Serves the given pages the way the driver's ResponseFuture does for a paged query
+    def __init__(self, column_names, pages):
+        self.column_names = column_names
+        self.pages = pages
+        self.page = 0
+        self.fetches = 0
+
+    @property
+    def has_more_pages(self):
+        return self.page < len(self.pages) - 1
+
+    def start_fetching_next_page(self):
+        self.page += 1
+        self.fetches += 1
+
+    def result(self):
+        return mock.Mock(column_names=self.column_names, current_rows=self.pages[self.page])
+
+
+def make_data_row(execution_id, value_id, primary_value_id=None):
+    return DataRow(
+        execution_id=execution_id,
+        is_primary=primary_value_id is None,
+        id=uuid.uuid4(),
+        depth=None,
+        device=None,
+        file_url='file.nc',
+        measurement_time=datetime(2018, 9, 27, 9, 0),
+        measurement_values_json='[{"variable_name": "sst", "variable_value": 20.5}]',
+        platform=None,
+        primary_value_id=primary_value_id,
+        source_dataset='test-dataset',
+        value_id=value_id,
+        x=-120.0,
+        y=35.0
+    )
+
+
+@pytest.fixture()
+def retrieval():
+    retrieval = ResultsRetrieval()
+    retrieval._session = mock.MagicMock()
+    retrieval._log = mock.MagicMock()
+    return retrieval
+
+
+def test_retrieve_data_attaches_secondaries_read_before_primaries(retrieval):
+    execution_id = uuid.uuid4()
+
+    # Secondary rows cluster before primary rows, and the partition spans two pages
+    pages = [
+        [make_data_row(execution_id, 's1', 'p1'), make_data_row(execution_id, 's2', 'missing')],
+        [make_data_row(execution_id, 'p1'), make_data_row(execution_id, 'p2')]
+    ]
+    future = FakeResponseFuture(DataRow._fields, pages)
+    retrieval._session.execute_async.return_value = future
+
+    data = retrieval._ResultsRetrieval__retrieveData(execution_id)
+
+    statement, params = retrieval._session.execute_async.call_args.args
+    assert 'is_primary' not in statement.query_string
+    assert statement.fetch_size == FETCH_SIZE
+    assert params == (execution_id,)
+    assert future.fetches == 1
+
+    assert [entry['id'] for entry in data] == ['p1', 'p2']
+    assert [match['id'] for match in data[0]['matches']] == ['s1']
+    assert data[0]['matches'][0]['secondary'] == [{'variable_name': 'sst', 'variable_value': 20.5}]
+    assert data[0]['primary'] == [{'variable_name': 'sst', 'variable_value': 20.5}]
+    assert data[0]['fileurl'] == 'file.nc'
+    assert 'matches' not in data[1]
+
+    retrieval._log.warning.assert_called_once()
+    assert 'missing' in retrieval._log.warning.call_args.args[0]
+
+
+def test_retrieve_data_old_schema(retrieval):
+    execution_id = uuid.uuid4()
+
+    def old_row(value_id, primary_value_id=None):
+        return OldSchemaDataRow(
+            execution_id=execution_id,
+            is_primary=primary_value_id is None,
+            id=uuid.uuid4(),
+            depth=None,
+            device=None,
+            measurement_time=datetime(2018, 9, 27, 9, 0),
+            measurement_values={'sst': '20.5'},
+            platform=None,
+            primary_value_id=primary_value_id,
+            source_dataset='test-dataset',
+            value_id=value_id,
+            x=-120.0,
+            y=35.0
+        )
+
+    pages = [[old_row('s1', 'p1')], [old_row('p1')]]
+    retrieval._session.execute_async.return_value = FakeResponseFuture(OldSchemaDataRow._fields, pages)
+
+    data = retrieval._ResultsRetrieval__retrieveData(execution_id)
+
+    assert len(data) == 1
+    assert data[0]['sst'] == 20.5
+    assert data[0]['fileurl'] is None
+    assert 'primary' not in data[0]
+    assert data[0]['matches'][0]['sst'] == 20.5
+    assert 'secondary' not in data[0]['matches'][0]
+
+
+def make_cluster(*args, **kwargs):
+    cluster = mock.MagicMock()
+    cluster.connect.return_value.cluster = cluster
+    return cluster
+
+
+def make_container(host):
+    config = configparser.RawConfigParser()
+    config.add_section('cassandra')
+    config.set('cassandra', 'host', host)
+
+    return AbstractResultsContainer(config)
+
+
+@pytest.fixture()
+def session_cache():
+    def reset():
+        results_storage._sessions.clear()
+        results_storage._connecting.clear()
+        results_storage._session_users.clear()
+        results_storage._retired_sessions.clear()
+        results_storage._prepared_statements.clear()
+
+    reset()
+
+    with mock.patch(f'{MODULE}.Cluster', side_effect=make_cluster) as cluster:
+        yield cluster
+
+    reset()
+
+
+def test_enter_reuses_session_for_same_config(session_cache):
+    first = make_container('cass-a')
+    second = make_container('cass-a')
+
+    with first, second:
+        assert first._session is second._session
+        assert results_storage._session_users[first._session] == 2
+
+    session_cache.assert_called_once()
+    first._cluster.shutdown.assert_not_called()
+    assert results_storage._session_users == {}
+
+
+def test_evicted_session_shut_down_by_last_exit(session_cache):
+    first = make_container('cass-a')
+    second = make_container('cass-a')
+
+    first.__enter__()
+    second.__enter__()
+    evicted = first._session
+
+    for i in range(SESSION_CACHE_SIZE):
+        with make_container(f'cass-{i}'):
+            pass
+
+    assert evicted in results_storage._retired_sessions
+    evicted.cluster.shutdown.assert_not_called()
+
+    first.__exit__(None, None, None)
+    evicted.cluster.shutdown.assert_not_called()
+
+    second.__exit__(None, None, None)
+    evicted.cluster.shutdown.assert_called_once()
+    assert evicted not in results_storage._retired_sessions
+
+
+def test_released_session_prepared_statements_are_dropped(session_cache):
+    container = make_container('cass-a')
+
+    with container:
+        container._prepare('SELECT * FROM doms_data')
+        session = container._session
+
+    assert (session, 'SELECT * FROM doms_data') in results_storage._prepared_statements
+
+    # Filling the cache with other configs evicts the first session, which no longer has users
+    for i in range(SESSION_CACHE_SIZE):
+        with make_container(f'cass-{i}'):
+            pass
+
+    session.cluster.shutdown.assert_called_once()
+    assert all(key[0] is not session for key in results_storage._prepared_statements)
+
+
+@pytest.mark.parametrize('dt_string', ['2018-01-02T03:04:05Z', '2018-01-02T03:04:05', '2018-01-02T05:04:05+02:00'])
+def test_parse_datetime_is_utc_millis(dt_string):
+    assert make_container('cass-a')._parseDatetime(dt_string) == 1514862245000
+
+
+def test_parse_datetime_rejects_date_only():
+    with pytest.raises(ValueError):
+        make_container('cass-a')._parseDatetime('2018-01-02')
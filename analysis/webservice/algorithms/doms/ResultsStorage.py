@@ -13,31 +13,108 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import configparser
 import json
 import logging
+import threading
+from collections import OrderedDict, deque
 from time import sleep
 import math
+import os
+import random
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 
 import numpy as np
 import pkg_resources
+from cassandra import InvalidRequest
 from cassandra.auth import PlainTextAuthProvider
 from cassandra.cluster import Cluster
+from cassandra.concurrent import execute_concurrent
 from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
-from cassandra.query import BatchStatement
+from cassandra.pool import HostDistance
+from cassandra.query import BatchStatement, BatchType, SimpleStatement
 from pytz import UTC
 from webservice.algorithms.doms.BaseDomsHandler import DomsEncoder
 from webservice.webmodel import NexusProcessingException
 
-BATCH_SIZE = 1024
+# Defaults for cassandra.write_concurrency / cassandra.batch_rows. The best values depend on row size,
+# cluster size and hardware; tune them per deployment by timing insertResults on a representative
+# matchup result while sweeping batch_rows (e.g. 10-200) and write_concurrency (e.g. 16-256), and keep
+# the fastest pair that doesn't cause write timeouts or rejected batches on the cluster.
+DEFAULT_WRITE_CONCURRENCY = 100
+DEFAULT_BATCH_ROWS = 50
+# Stay well under Cassandra's default batch_size_fail_threshold (50KB)
+BATCH_MAX_BYTES = 40 * 1024
+# Estimated size of a doms_data row's fixed-width cells (two uuids, three decimals, a timestamp and a
+# boolean) plus per-cell overhead; text columns are counted separately
+ROW_OVERHEAD_BYTES = 160
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 30.0
+FETCH_SIZE = 5000
+UUID_CHUNK_SIZE = 1024
+SESSION_CACHE_SIZE = 2
+# Pre-serialized measurement_values_json for results with no primary/secondary values
+EMPTY_JSON = "[]"
+
+_EPOCH = datetime(1970, 1, 1)
 
 
 class ResultInsertException(IOError):
     pass
 
 
+def _estimate_row_bytes(entry):
+    return ROW_OVERHEAD_BYTES + sum(len(value.encode('utf-8')) for value in entry if isinstance(value, str))
+
+
+def _random_uuids(chunk_size=UUID_CHUNK_SIZE):
+    # Equivalent to repeated uuid.uuid4() calls, but reads the random bytes for a whole chunk of ids
+    # with one os.urandom call rather than one per id
+    while True:
+        raw = os.urandom(16 * chunk_size)
+
+        for i in range(0, len(raw), 16):
+            yield uuid.UUID(bytes=raw[i:i + 16], version=4)
+
+
+# Cluster setup (control connection, schema metadata, connection pools) is expensive, so sessions are
+# shared across requests, keyed on the connection config. A session evicted from the cache is only shut
+# down once no open container is still using it; anything left is shut down at exit. Connecting and
+# shutting down happen outside _sessions_lock so a slow cluster doesn't block users of other sessions.
+_sessions = OrderedDict()
+_connecting = {}
+_session_users = {}
+_retired_sessions = set()
+_prepared_statements = {}
+_sessions_lock = threading.Lock()
+
+
+def _forget_session(session):
+    # Caller must hold _sessions_lock, and shuts the session's cluster down once it has released it
+    for prepared_key in [k for k in _prepared_statements if k[0] is session]:
+        del _prepared_statements[prepared_key]
+
+
+def _shutdown_sessions():
+    with _sessions_lock:
+        sessions = list(_sessions.values()) + list(_retired_sessions)
+
+        for session in sessions:
+            _forget_session(session)
+
+        _sessions.clear()
+        _retired_sessions.clear()
+        _session_users.clear()
+
+    for session in sessions:
+        session.cluster.shutdown()
+
+
+atexit.register(_shutdown_sessions)
+
+
 class AbstractResultsContainer:
     def __init__(self, config=None):
         self._log = logging.getLogger(__name__)
@@ -59,26 +136,149 @@ class AbstractResultsContainer:
         cassVersion = int(self._config.get("cassandra", "protocol_version"))
         cassUsername = self._config.get("cassandra", "username")
         cassPassword = self._config.get("cassandra", "password")
+        coreConns = self._config.get("cassandra", "core_conns", fallback=None) or None
+        maxConns = self._config.get("cassandra", "max_conns", fallback=None) or None
+
+        # Connection pool sizing only applies to protocol v1/v2; v3+ multiplexes requests over a single
+        # connection per host and the driver rejects these settings
+        poolSizingIgnored = cassVersion >= 3 and (coreConns is not None or maxConns is not None)
+
+        if cassVersion >= 3:
+            coreConns = maxConns = None
+        else:
+            coreConns = int(coreConns or 2)
+            maxConns = int(maxConns or 8)
+
+        key = (cassHost, cassKeyspace, cassDatacenter, cassVersion, cassUsername, cassPassword, coreConns, maxConns)
+
+        while True:
+            with _sessions_lock:
+                if key in _sessions:
+                    _sessions.move_to_end(key)
+                    self._session = _sessions[key]
+                    _session_users[self._session] += 1
+                    break
+
+                # Reserve the key so concurrent requests for the same config wait for this connect
+                # rather than opening their own
+                connected = _connecting.get(key)
+
+                if connected is None:
+                    connected = _connecting[key] = threading.Event()
+                    connect_here = True
+                else:
+                    connect_here = False
+
+            if not connect_here:
+                connected.wait()
+                continue
+
+            try:
+                session = self.__connect(cassHost, cassKeyspace, cassDatacenter, cassVersion, cassUsername,
+                                         cassPassword, coreConns, maxConns, poolSizingIgnored)
+            except Exception:
+                with _sessions_lock:
+                    del _connecting[key]
+
+                connected.set()
+                raise
+
+            evicted = None
+
+            with _sessions_lock:
+                del _connecting[key]
+                _sessions[key] = session
+                _session_users[session] = 1
+                self._session = session
+
+                if len(_sessions) > SESSION_CACHE_SIZE:
+                    _, evicted = _sessions.popitem(last=False)
+
+                    if _session_users.get(evicted, 0) == 0:
+                        _session_users.pop(evicted, None)
+                        _forget_session(evicted)
+                    else:
+                        _retired_sessions.add(evicted)
+                        evicted = None
+
+            connected.set()
+
+            if evicted is not None:
+                evicted.cluster.shutdown()
 
+            break
+
+        self._cluster = self._session.cluster
+        return self
+
+    def __connect(self, cassHost, cassKeyspace, cassDatacenter, cassVersion, cassUsername, cassPassword,
+                  coreConns, maxConns, poolSizingIgnored):
         auth_provider = PlainTextAuthProvider(username=cassUsername, password=cassPassword)
 
         dc_policy = DCAwareRoundRobinPolicy(cassDatacenter)
-        token_policy = TokenAwarePolicy(dc_policy)
+        # Prepared inserts carry the partition key (execution_id) so the driver routes them straight to a
+        # local replica; shuffling spreads the load across replicas instead of always hitting the first
+        token_policy = TokenAwarePolicy(dc_policy, shuffle_replicas=True)
 
-        self._cluster = Cluster([host for host in cassHost.split(',')], load_balancing_policy=token_policy,
-                                protocol_version=cassVersion, auth_provider=auth_provider)
+        cluster = Cluster([host for host in cassHost.split(',')], load_balancing_policy=token_policy,
+                          protocol_version=cassVersion, auth_provider=auth_provider)
 
-        self._session = self._cluster.connect(cassKeyspace)
-        return self
+        if poolSizingIgnored:
+            self._log.warning(f'cassandra.core_conns and cassandra.max_conns only apply to protocol versions '
+                              f'1 and 2; ignoring them for protocol version {cassVersion}')
+
+        if cassVersion < 3:
+            cluster.set_core_connections_per_host(HostDistance.LOCAL, coreConns)
+            cluster.set_max_connections_per_host(HostDistance.LOCAL, maxConns)
+
+        self._log.info(f'Connecting to Cassandra cluster at {cassHost}')
+        return cluster.connect(cassKeyspace)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._cluster.shutdown()
+        # The session is shared with other requests, so it is only shut down here if it has been evicted
+        # from the cache and this was its last user
+        release = False
+
+        with _sessions_lock:
+            users = _session_users.pop(self._session, 0) - 1
+
+            if users > 0:
+                _session_users[self._session] = users
+            elif self._session in _retired_sessions:
+                _retired_sessions.remove(self._session)
+                _forget_session(self._session)
+                release = True
+
+        if release:
+            self._session.cluster.shutdown()
+
+    def _prepare(self, cql):
+        with _sessions_lock:
+            prepared = _prepared_statements.get((self._session, cql))
+
+        if prepared is None:
+            # Prepare outside the lock so a slow round trip doesn't block other requests; a concurrent
+            # prepare of the same statement is harmless
+            prepared = self._session.prepare(cql)
+
+            with _sessions_lock:
+                _prepared_statements[(self._session, cql)] = prepared
+
+        return prepared
 
     def _parseDatetime(self, dtString):
-        dt = datetime.strptime(dtString, "%Y-%m-%dT%H:%M:%SZ")
-        epoch = datetime.utcfromtimestamp(0)
-        time = (dt - epoch).total_seconds() * 1000.0
-        return int(time)
+        # fromisoformat also takes date-only strings, which the old strptime format rejected
+        if 'T' not in dtString:
+            raise ValueError(f'Invalid datetime string, expected YYYY-MM-DDTHH:MM:SSZ: {dtString}')
+
+        # fromisoformat only understands a trailing 'Z' from Python 3.11 on
+        dt = datetime.fromisoformat(dtString[:-1] if dtString.endswith('Z') else dtString)
+
+        # Explicit offsets give an aware datetime; normalise to naive UTC to match _EPOCH
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+        return int((dt - _EPOCH).total_seconds() * 1000)
 
     def override_config(self, config):
         for section in config.sections():
@@ -105,15 +305,69 @@ class AbstractResultsContainer:
 class ResultsStorage(AbstractResultsContainer):
     def __init__(self, config=None):
         AbstractResultsContainer.__init__(self, config)
+        self._doms_encoder = DomsEncoder()
+        self._batch_rows = int(self._config.get("cassandra", "batch_rows", fallback=DEFAULT_BATCH_ROWS))
+        self._write_concurrency = int(
+            self._config.get("cassandra", "write_concurrency", fallback=DEFAULT_WRITE_CONCURRENCY)
+        )
+
+    def __enter__(self):
+        AbstractResultsContainer.__enter__(self)
+
+        try:
+            self.__prepareStatements()
+        except Exception:
+            AbstractResultsContainer.__exit__(self, None, None, None)
+            raise
+
+        return self
+
+    def __prepareStatements(self):
+        # Prepare all inserts once per shared session so each write skips the server-side parse
+        self._prep_exec = self._prepare(
+            "INSERT INTO doms_executions (id, time_started, time_completed, user_email) VALUES (?, ?, ?, ?)"
+        )
+
+        self._prep_params = self._prepare("""
+           INSERT INTO doms_params
+                (execution_id, primary_dataset, matchup_datasets, depth_min, depth_max, time_tolerance, radius_tolerance, start_time, end_time, platforms, bounding_box, parameter)
+           VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """)
+
+        self._prep_stats = self._prepare("""
+           INSERT INTO doms_execution_stats
+                (execution_id, num_gridded_matched, num_gridded_checked, num_insitu_matched, num_insitu_checked, time_to_complete)
+           VALUES
+                (?, ?, ?, ?, ?, ?)
+        """)
+
+        self._prep_data = self._prepare("""
+           INSERT INTO doms_data
+                (id, execution_id, value_id, primary_value_id, x, y, source_dataset, measurement_time, platform, device, measurement_values_json, is_primary, depth, file_url)
+           VALUES
+                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """)
 
     def insertResults(self, results, params, stats, startTime, completeTime, userEmail, execution_id=None):
         self._log.info('Beginning results write')
         if isinstance(execution_id, str):
             execution_id = uuid.UUID(execution_id)
 
-        execution_id = self.insertExecution(execution_id, startTime, completeTime, userEmail)
-        self.__insertParams(execution_id, params)
-        self.__insertStats(execution_id, stats)
+        if execution_id is None:
+            execution_id = uuid.uuid4()
+
+        # The id is generated client-side, so the three metadata writes are independent and can be in
+        # flight together
+        futures = [
+            self.__insertExecutionAsync(execution_id, startTime, completeTime, userEmail),
+            self.__insertParams(execution_id, params),
+            self.__insertStats(execution_id, stats)
+        ]
+
+        for future in futures:
+            future.result()
+
         self.__insertResults(execution_id, results)
         self._log.info('Results write finished')
         return execution_id
@@ -122,39 +376,30 @@ class ResultsStorage(AbstractResultsContainer):
         if execution_id is None:
             execution_id = uuid.uuid4()
 
-        cql = "INSERT INTO doms_executions (id, time_started, time_completed, user_email) VALUES (%s, %s, %s, %s)"
-        self._session.execute(cql, (execution_id, startTime, completeTime, userEmail))
+        self.__insertExecutionAsync(execution_id, startTime, completeTime, userEmail).result()
         return execution_id
 
+    def __insertExecutionAsync(self, execution_id, startTime, completeTime, userEmail):
+        return self._session.execute_async(self._prep_exec, (execution_id, startTime, completeTime, userEmail))
+
     def __insertParams(self, execution_id, params):
-        cql = """INSERT INTO doms_params
-                    (execution_id, primary_dataset, matchup_datasets, depth_min, depth_max, time_tolerance, radius_tolerance, start_time, end_time, platforms, bounding_box, parameter)
-                 VALUES
-                    (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        self._session.execute(cql, (execution_id,
-                                    params["primary"],
-                                    ",".join(params["matchup"]) if type(params["matchup"]) == list else params[
-                                        "matchup"],
-                                    params["depthMin"] if "depthMin" in list(params.keys()) else None,
-                                    params["depthMax"] if "depthMax" in list(params.keys()) else None,
-                                    int(params["timeTolerance"]),
-                                    params["radiusTolerance"],
-                                    params["startTime"],
-                                    params["endTime"],
-                                    params["platforms"],
-                                    params["bbox"],
-                                    params["parameter"]
-                                    ))
+        return self._session.execute_async(self._prep_params, (
+            execution_id,
+            params["primary"],
+            ",".join(params["matchup"]) if isinstance(params["matchup"], list) else params["matchup"],
+            params.get("depthMin"),
+            params.get("depthMax"),
+            int(params["timeTolerance"]),
+            params["radiusTolerance"],
+            params["startTime"],
+            params["endTime"],
+            params["platforms"],
+            params["bbox"],
+            params["parameter"]
+        ))
 
     def __insertStats(self, execution_id, stats):
-        cql = """
-           INSERT INTO doms_execution_stats
-                (execution_id, num_gridded_matched, num_gridded_checked, num_insitu_matched, num_insitu_checked, time_to_complete)
-           VALUES
-                (%s, %s, %s, %s, %s, %s)
-        """
-        self._session.execute(cql, (
+        return self._session.execute_async(self._prep_stats, (
             execution_id,
             stats["numPrimaryMatched"],
             None,
@@ -164,100 +409,159 @@ class ResultsStorage(AbstractResultsContainer):
         ))
 
     def __insertResults(self, execution_id, results):
-
-        cql = """
-           INSERT INTO doms_data
-                (id, execution_id, value_id, primary_value_id, x, y, source_dataset, measurement_time, platform, device, measurement_values_json, is_primary, depth, file_url)
-           VALUES
-                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
-        insertStatement = self._session.prepare(cql)
-
-        inserts = []
-
-        for result in results:
-            inserts.extend(self.__prepare_result(execution_id, None, result, insertStatement))
+        # Rows are kept in a list so failed ones can be retried
+        inserts = list(self.__prepare_results(execution_id, results))
 
         for i in range(5):
-            if not self.__insert_result_batches(inserts, insertStatement):
+            inserts = self.__insert_result_batches(inserts)
+
+            if len(inserts) > 0:
                 if i < 4:
-                    self._log.warning('Some write attempts failed; retrying')
-                    sleep(10)
+                    # Full-jitter exponential backoff so concurrent writers don't retry in lockstep
+                    delay = random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * (2 ** i)))
+                    self._log.warning(f'{len(inserts)} write attempts failed; retrying in {delay:.2f}s')
+                    sleep(delay)
                 else:
                     self._log.error('Some write attempts failed; max retries exceeded')
                     raise ResultInsertException('Some result inserts failed')
             else:
                 break
 
-
-    def __insert_result_batches(self, insert_params, insertStatement):
-        query_batches = [insert_params[i:i + BATCH_SIZE] for i in range(0, len(insert_params), BATCH_SIZE)]
-        move_successful = True
-
+    def __insert_result_batches(self, insert_params):
+        # Returns the rows that failed to write so only those are retried
         n_inserts = len(insert_params)
-        writing = 0
 
         self._log.info(f'Inserting {n_inserts} matchup entries in JSON format')
 
-        for batch in query_batches:
-            futures = []
-            writing += len(batch)
-            self._log.info(
-                f'Writing batch of {len(batch)} matchup entries | ({writing}/{n_inserts}) [{writing / n_inserts * 100:7.3f}%]')
-
-            for entry in batch:
-                futures.append(self._session.execute_async(insertStatement, entry))
-
-            for future in futures:
-                try:
-                    future.result()
-                except Exception:
-                    move_successful = False
-
-        self._log.info('Result data write attempt completed')
-        return move_successful
-
-    def __prepare_result(self, execution_id, primaryId, result, insertStatement):
-        if 'primary' in result:
-            data = result['primary']
-        elif 'secondary' in result:
-            data = result['secondary']
-        else:
-            data = []
+        failed, rejected = self.__execute_row_groups(self.__group_result_batches(insert_params, self._batch_rows))
 
-        result_id = uuid.uuid4()
+        # A batch the server refuses (e.g. over batch_size_fail_threshold) will be refused again on retry, so
+        # write its rows as individual statements instead
+        if len(rejected) > 0:
+            self._log.warning(f'{len(rejected)} batches were rejected; writing their rows individually')
+            failed.extend(self.__execute_row_groups([row] for rows in rejected for row in rows)[0])
 
-        insert_params = (
-            result_id,
-            execution_id,
-            result["id"],
-            primaryId,
-            result["lon"],
-            result["lat"],
-            result["source"],
-            result["time"],
-            result["platform"] if "platform" in result else None,
-            result["device"] if "device" in result else None,
-            json.dumps(data, cls=DomsEncoder),
-            1 if primaryId is None else 0,
-            result["depth"],
-            result['fileurl']
+        self._log.info(f'Result data write attempt completed | '
+                       f'({n_inserts - len(failed)}/{n_inserts}) entries written')
+        return failed
+
+    def __execute_row_groups(self, groups):
+        # Writes each group of rows as one statement: an unlogged batch, or a plain statement for a single row.
+        # Returns the rows that failed, and the multi-row groups the server rejected as invalid.
+        statement_rows = []
+        errors = []
+
+        # Statements are bound lazily so only the in-flight window is held in memory. After the first window
+        # the driver pulls them from its I/O thread, where an exception would be swallowed, so errors are
+        # recorded here, end the stream, and are re-raised once execute_concurrent returns.
+        def statements():
+            try:
+                for rows in groups:
+                    if len(rows) == 1:
+                        statement = (self._prep_data, rows[0])
+                    else:
+                        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+
+                        for entry in rows:
+                            batch.add(self._prep_data, entry)
+
+                        statement = (batch, ())
+
+                    statement_rows.append(rows)
+                    yield statement
+            except Exception as e:
+                errors.append(e)
+
+        results = execute_concurrent(
+            self._session,
+            statements(),
+            concurrency=self._write_concurrency,
+            raise_on_first_error=False
         )
 
-        params_list = [insert_params]
+        if len(errors) > 0:
+            raise errors[0]
 
-        if "matches" in result:
-            for match in result["matches"]:
-                params_list.extend(self.__prepare_result(execution_id, result["id"], match, insertStatement))
+        failed = []
+        rejected = []
 
-        return params_list
+        for rows, (success, result) in zip(statement_rows, results):
+            if success:
+                continue
+
+            if len(rows) > 1 and isinstance(result, InvalidRequest):
+                rejected.append(rows)
+            else:
+                failed.extend(rows)
 
+        return failed, rejected
 
+    @staticmethod
+    def __group_result_batches(insert_params, batch_rows):
+        # Rows are only batched together when they share a partition (execution_id), so each unlogged
+        # batch is a single mutation on one replica set. A row too large to share a batch is yielded
+        # on its own and written as a plain statement.
+        batch = []
+        batch_bytes = 0
+
+        for entry in insert_params:
+            execution_id = entry[1]
+            entry_bytes = _estimate_row_bytes(entry)
+
+            if batch and (len(batch) >= batch_rows
+                          or batch_bytes + entry_bytes > BATCH_MAX_BYTES
+                          or batch[0][1] != execution_id):
+                yield batch
+                batch = []
+                batch_bytes = 0
+
+            batch.append(entry)
+            batch_bytes += entry_bytes
+
+        if batch:
+            yield batch
+
+    def __prepare_results(self, execution_id, results):
+        # Walk the match trees breadth-first with a queue rather than recursing, so arbitrarily deep or
+        # wide match sets don't hit the recursion limit or build intermediate lists
+        result_ids = _random_uuids()
+        queue = deque((None, result) for result in results)
+
+        while queue:
+            primaryId, result = queue.popleft()
+
+            if 'primary' in result:
+                values_json = self._doms_encoder.encode(result['primary'])
+            elif 'secondary' in result:
+                values_json = self._doms_encoder.encode(result['secondary'])
+            else:
+                values_json = EMPTY_JSON
+
+            yield (
+                next(result_ids),
+                execution_id,
+                result["id"],
+                primaryId,
+                result["lon"],
+                result["lat"],
+                result["source"],
+                result["time"],
+                result.get("platform"),
+                result.get("device"),
+                values_json,
+                1 if primaryId is None else 0,
+                result["depth"],
+                result['fileurl']
+            )
+
+            queue.extend((result["id"], match) for match in result.get("matches", ()))
 
 
 class ResultsRetrieval(AbstractResultsContainer):
     def __init__(self, config=None):
         AbstractResultsContainer.__init__(self, config)
+        self._has_file_url = True
+        self._has_measurement_values_json = True
 
     def retrieveResults(self, execution_id, trim_data=False):
         if isinstance(execution_id, str):
@@ -269,33 +573,56 @@ class ResultsRetrieval(AbstractResultsContainer):
         return params, stats, data
 
     def __retrieveData(self, id, trim_data=False):
-        dataMap = self.__retrievePrimaryData(id, trim_data=trim_data)
-        self.__enrichPrimaryDataWithMatches(id, dataMap, trim_data=trim_data)
-        data = [dataMap[name] for name in dataMap]
-        return data
+        # Read the whole partition in one query. Rows cluster on is_primary, so secondary rows can arrive
+        # before the primary they belong to and are attached once every primary has been read.
+        cql = "SELECT * FROM doms_data where execution_id = %s"
 
-    def __enrichPrimaryDataWithMatches(self, id, dataMap, trim_data=False):
-        cql = "SELECT * FROM doms_data where execution_id = %s and is_primary = false"
-        rows = self._session.execute(cql, (id,))
+        dataMap = {}
+        matches = []
 
-        for row in rows:
+        for row in self.__iterateRows(cql, (id,)):
             entry = self.__rowToDataEntry(row, trim_data=trim_data)
-            if row.primary_value_id in dataMap:
-                if not "matches" in dataMap[row.primary_value_id]:
-                    dataMap[row.primary_value_id]["matches"] = []
-                dataMap[row.primary_value_id]["matches"].append(entry)
+
+            if row.is_primary:
+                dataMap[row.value_id] = entry
             else:
-                print(row)
+                matches.append((row.primary_value_id, entry))
 
-    def __retrievePrimaryData(self, id, trim_data=False):
-        cql = "SELECT * FROM doms_data where execution_id = %s and is_primary = true"
-        rows = self._session.execute(cql, (id,))
+        for primary_value_id, entry in matches:
+            primary = dataMap.get(primary_value_id)
+            if primary is not None:
+                primary.setdefault("matches", []).append(entry)
+            else:
+                self._log.warning(f'Secondary result has no primary with id {primary_value_id}')
 
-        dataMap = {}
-        for row in rows:
-            entry = self.__rowToDataEntry(row, trim_data=trim_data)
-            dataMap[row.value_id] = entry
-        return dataMap
+        data = list(dataMap.values())
+        return data
+
+    def __iterateRows(self, cql, params):
+        # Page through the results FETCH_SIZE rows at a time, requesting the next page before the
+        # current one is processed so fetching overlaps with building the entries
+        future = self._session.execute_async(SimpleStatement(cql, fetch_size=FETCH_SIZE), params)
+        result = future.result()
+
+        # doms_data may still use the old schema; check its columns once per query rather than per row
+        column_names = result.column_names or ()
+        self._has_file_url = 'file_url' in column_names
+        self._has_measurement_values_json = 'measurement_values_json' in column_names
+
+        page = result.current_rows
+
+        while True:
+            has_more_pages = future.has_more_pages
+
+            if has_more_pages:
+                future.start_fetching_next_page()
+
+            yield from page
+
+            if not has_more_pages:
+                break
+
+            page = future.result().current_rows
 
     def __rowToDataEntry(self, row, trim_data=False):
         if trim_data:
@@ -314,16 +641,15 @@ class ResultsRetrieval(AbstractResultsContainer):
                 "point": f"Point({float(row.x):.3f} {float(row.y):.3f})",
                 "time": row.measurement_time.replace(tzinfo=UTC),
                 "depth": float(row.depth) if row.depth is not None else None,
-                "fileurl": row.file_url if hasattr(row, 'file_url') else None,
+                "fileurl": row.file_url if self._has_file_url else None,
                 "id": row.value_id,
                 "source": row.source_dataset,
             }
 
         # If doms_data uses the old schema, default to original behavior
-
-        try:
+        if self._has_measurement_values_json:
             entry['primary' if row.is_primary else 'secondary'] = json.loads(row.measurement_values_json)
-        except AttributeError:
+        else:
             for key in row.measurement_values:
                 value = float(row.measurement_values[key])
                 entry[key] = value